@@ -1,9 +1,17 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import gzip
+import shutil
 import json
+import hashlib
+import orjson
+import time
 import pandas as pd
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 dotenv_path = '../secret/.env'
@@ -17,12 +25,59 @@ BASE_URL = "https://www.strava.com/api/v3"
 
 # Metadata file and CSV file paths
 METADATA_FILE = "activity_metadata.json"
-CSV_FILE = "activities.csv"
+CSV_FILE = "activities.csv.gz"
+LEGACY_CSV_FILE = "activities.csv"
 
-def get_strava_session():
+# Fast gzip level: most of the size reduction for little CPU
+CSV_COMPRESSION = {"method": "gzip", "compresslevel": 1}
+
+# All CSV writes go through this hook so tests can replace it
+_csv_writer = pd.DataFrame.to_csv
+
+# Local cache of API responses that rarely change
+CACHE_FILE = ".strava_cache.json"
+ATHLETE_CACHE_TTL = 36 * 60 * 60
+# Refresh the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# Activity pagination
+PER_PAGE = 200  # Strava's maximum
+PAGE_CONCURRENCY = 4
+
+# Strava's short-term rate limit window, in seconds
+RATE_LIMIT_WINDOW = 15 * 60
+# Extra seconds to wait past the reset in case the local clock runs ahead
+RATE_LIMIT_RESET_MARGIN = 5
+
+class StravaAuthError(Exception):
     """
-    Creates a requests.Session with the access token header.
+    Raised when Strava refuses to issue an access token.
+    """
+
+def create_session():
+    """
+    Creates a requests.Session with a connection pool sized for concurrent page
+    fetches that retries transient server errors.
     """
+    # 429s are left to the rate limit handling in fetch_new_activities
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=PAGE_CONCURRENCY, max_retries=retries)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+# Sessions are built through this hook so tests can replace it
+_session_factory = create_session
+
+def get_access_token():
+    """
+    Returns an access token, reusing the cached one until it is about to expire.
+    """
+    cache = load_cache()
+    if cache.get("expires_at", 0) > time.time() + TOKEN_EXPIRY_MARGIN:
+        return cache["access_token"]
+
     url = "https://www.strava.com/oauth/token"
     payload = {
         "client_id": STRAVA_CLIENT_ID,
@@ -33,12 +88,22 @@ def get_strava_session():
     
     response = requests.post(url, data=payload)
     if response.status_code == 200:
-        access_token = response.json()["access_token"]
-        session = requests.Session()
-        session.headers.update({"Authorization": f"Bearer {access_token}"})
-        return session
+        token = response.json()
+        cache["access_token"] = token["access_token"]
+        cache["expires_at"] = token.get("expires_at", 0)
+        save_cache(cache)
+        return token["access_token"]
     else:
-        raise Exception(f"Failed to get access token: {response.status_code} {response.text}")
+        raise StravaAuthError(f"Failed to get access token: {response.status_code} {response.text}")
+
+def get_strava_session():
+    """
+    Creates a requests.Session with the access token header.
+    """
+    access_token = get_access_token()
+    session = _session_factory()
+    session.headers.update({"Authorization": f"Bearer {access_token}"})
+    return session
 
 def load_metadata():
     if os.path.exists(METADATA_FILE):
@@ -51,101 +116,279 @@ def save_metadata(record_count, last_activity_date):
     with open(METADATA_FILE, "w") as f:
         json.dump(metadata, f)
 
+def credentials_fingerprint():
+    """
+    Identifies the credentials the cache was built with, without storing the
+    refresh token itself.
+    """
+    return hashlib.sha256(f"{STRAVA_CLIENT_ID}:{STRAVA_REFRESH_TOKEN}".encode()).hexdigest()
+
+def load_cache():
+    # A cache written for other credentials (new scope, another account) holds
+    # the wrong token and athlete, so it is ignored
+    if os.path.exists(CACHE_FILE):
+        with open(CACHE_FILE, "r") as f:
+            cache = json.load(f)
+        if cache.get("credentials") == credentials_fingerprint():
+            return cache
+    return {}
+
+def save_cache(cache):
+    cache["credentials"] = credentials_fingerprint()
+    with open(CACHE_FILE, "w") as f:
+        json.dump(cache, f)
+
+def migrate_legacy_csv():
+    """
+    Copies an existing uncompressed activities CSV into the compressed CSV file once.
+    """
+    if os.path.exists(LEGACY_CSV_FILE) and not os.path.exists(CSV_FILE):
+        # Compress into a temp file and swap it in, so an interrupted copy
+        # never leaves a truncated CSV_FILE that would block the next attempt
+        temp_file = CSV_FILE + ".tmp"
+        try:
+            with open(LEGACY_CSV_FILE, "rb") as src, gzip.open(temp_file, "wb", compresslevel=CSV_COMPRESSION["compresslevel"]) as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(temp_file, CSV_FILE)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        print(f"Compressed {LEGACY_CSV_FILE} into {CSV_FILE}")
+
+def read_csv_header():
+    """
+    Returns the columns of the CSV file, or None if it is missing or empty.
+    """
+    try:
+        return pd.read_csv(CSV_FILE, nrows=0).columns
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return None
+
+def append_activities_to_csv(df):
+    """
+    Appends a batch of normalized activities to the CSV file with a single write.
+    """
+    migrate_legacy_csv()
+
+    # Fields that are empty for the whole batch (e.g. power or heart rate for an
+    # athlete without those sensors) would only add an empty cell to every row
+    df = df.dropna(axis=1, how="all")
+
+    columns = read_csv_header()
+    if columns is None:
+        _csv_writer(df, CSV_FILE, mode='w', header=True, index=False, compression=CSV_COMPRESSION)
+    elif df.columns.isin(columns).all():
+        # The header already fixes the column order, so select those fields
+        # directly instead of letting each batch decide its own layout.
+        _csv_writer(df.reindex(columns=columns), CSV_FILE, mode='a', header=False, index=False, compression=CSV_COMPRESSION)
+    else:
+        # A field with data showed up that the header lacks: rewrite the file
+        # once with the wider header rather than dropping it. Existing rows are
+        # read as text so they are written back unchanged. The new file is
+        # written next to the old one and swapped in, so a failed write never
+        # truncates the only copy of the history.
+        existing = pd.read_csv(CSV_FILE, dtype=str, keep_default_na=False)
+        combined = pd.concat([existing, df], ignore_index=True)
+        temp_file = CSV_FILE + ".tmp"
+        try:
+            _csv_writer(combined, temp_file, mode='w', header=True, index=False, compression=CSV_COMPRESSION)
+            os.replace(temp_file, CSV_FILE)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+def get_athlete(session):
+    """
+    Returns the athlete profile, reusing the cached copy while it is fresh.
+    """
+    cache = load_cache()
+    athlete = cache.get("athlete")
+    if athlete and cache.get("athlete_fetched_at", 0) + ATHLETE_CACHE_TTL > time.time():
+        return athlete
+
+    response = session.get(f"{BASE_URL}/athlete")
+    if response.status_code != 200:
+        raise Exception(f"Failed to retrieve athlete data: {response.status_code} {response.text}")
+
+    cache["athlete"] = response.json()
+    cache["athlete_fetched_at"] = time.time()
+    save_cache(cache)
+    return cache["athlete"]
+
 def get_athlete_stats():
     try:
         session = get_strava_session()
         
-        response = session.get(f"{BASE_URL}/athlete")
-        if response.status_code == 200:
-            athlete_data = response.json()
-            print("Athlete Details:")
-            print(athlete_data)
-
-            # Get stats for the athlete
-            stats_url = f"{BASE_URL}/athletes/{athlete_data['id']}/stats"
-            stats_response = session.get(stats_url)
-
-            if stats_response.status_code == 200:
-                return stats_response.json()
-            else:
-                raise Exception(f"Failed to retrieve stats: {stats_response.status_code} {stats_response.text}")
+        athlete_data = get_athlete(session)
+        print("Athlete Details:")
+        print(athlete_data)
+
+        # Get stats for the athlete
+        stats_url = f"{BASE_URL}/athletes/{athlete_data['id']}/stats"
+        stats_response = session.get(stats_url)
+
+        if stats_response.status_code == 200:
+            return stats_response.json()
         else:
-            raise Exception(f"Failed to retrieve athlete data: {response.status_code} {response.text}")
+            raise Exception(f"Failed to retrieve stats: {stats_response.status_code} {stats_response.text}")
     except Exception as e:
         print(e)
         return None
 
+def remaining_requests(response):
+    """
+    Returns the (15-minute, daily) requests left according to Strava's rate limit
+    headers, or None if the response does not report them. Reads such as the
+    activity list also count against the lower read limit, so the tighter of the
+    overall and read budgets is returned.
+    """
+    budgets = []
+    for prefix in ("X-RateLimit", "X-ReadRateLimit"):
+        try:
+            short_limit, daily_limit = (int(v) for v in response.headers[f"{prefix}-Limit"].split(","))
+            short_used, daily_used = (int(v) for v in response.headers[f"{prefix}-Usage"].split(","))
+        except (KeyError, AttributeError, TypeError, ValueError):
+            continue
+        budgets.append((short_limit - short_used, daily_limit - daily_used))
+    if not budgets:
+        return None
+    return tuple(min(left) for left in zip(*budgets))
+
+def seconds_until_rate_limit_reset():
+    """
+    Strava's 15-minute limits reset at the next quarter hour. A small margin
+    keeps a clock running slightly ahead from retrying before the reset.
+    """
+    return RATE_LIMIT_WINDOW - time.time() % RATE_LIMIT_WINDOW + RATE_LIMIT_RESET_MARGIN
+
+def fetch_activity_page(session, page, after):
+    """
+    Requests a single page of the athlete's activities started after the given epoch time.
+    """
+    params = {"per_page": PER_PAGE, "page": page, "after": after}
+    return session.get(f"{BASE_URL}/athlete/activities", params=params)
+
 def fetch_new_activities():
     metadata = load_metadata()
     last_activity_date = metadata.get("last_activity_date")
     total_record_count = metadata.get("record_count", 0)
     
-    new_activities = []
+    # Each window of concurrently fetched pages is flattened in one json_normalize
+    # call so only that window's raw JSON is held at a time; the flat frames
+    # are written together at the end.
+    new_frames = []
+    new_count = 0
+    latest_date = None
     
     try:
+        # Move an existing uncompressed history over even when nothing new is
+        # fetched, so the compressed CSV is always there to query
+        migrate_legacy_csv()
+
+        # The saved progress only counts if the CSV it describes is still there;
+        # otherwise (fresh clone, deleted CSV) fetch the full history again
+        if last_activity_date and read_csv_header() is None:
+            print(f"{CSV_FILE} not found. Fetching all activities.")
+            last_activity_date = None
+            total_record_count = 0
+
         session = get_strava_session()
-        activities_url = f"{BASE_URL}/athlete/activities"
-        params = {"per_page": 50, "page": 1}
         
-        # If we have a last activity date, we can use 'after' parameter if we were fetching chronologically,
-        # but Strava API default is reverse chronological (newest first).
-        # So we fetch pages until we hit a date <= last_activity_date.
+        # Only ask for activities after the last one we saved. With 'after' set,
+        # Strava returns pages oldest first, so we page until the list runs out.
+        # A full backfill uses after=0 to get the same ordering.
+        after = 0
+        if last_activity_date:
+            after = int(datetime.fromisoformat(last_activity_date.replace("Z", "+00:00")).timestamp())
         
         print("Fetching activities...")
-        while True:
-            response = session.get(activities_url, params=params)
-            
-            if response.status_code == 429:
-                print("Rate limit exceeded. Exiting.")
-                break
-
-            if response.status_code == 200:
-                activities = response.json()
-                if not activities:
-                    break
-
-                stop_fetching = False
-                for activity in activities:
-                    # Check if we've reached already processed activities
-                    # Note: String comparison works for ISO format dates
-                    if last_activity_date and activity["start_date"] <= last_activity_date:
-                        stop_fetching = True
+        with ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY) as executor:
+            page = 1
+            budget = None
+            waited = False
+            done = False
+            while not done:
+                # Fetch page 1 on its own: incremental runs usually stop there.
+                # Once a full page comes back, request the next pages concurrently.
+                window = 1 if page == 1 else PAGE_CONCURRENCY
+
+                # Stay under the limits reported by the last response instead of
+                # running into a 429
+                if budget is not None:
+                    short_left, daily_left = budget
+                    if daily_left <= 0:
+                        print("Daily rate limit reached. Exiting.")
                         break
-                    
-                    new_activities.append(activity)
-                    print(f"Found new activity: {activity['start_date']}")
-
-                if stop_fetching:
-                    break
-                
-                params["page"] += 1
-            else:
-                raise Exception(f"Failed to retrieve activities: {response.status_code} {response.text}")
-
-        if new_activities:
-            # Normalize JSON to flat table
-            df = pd.json_normalize(new_activities)
-            
-            # Ensure consistent columns if needed, or just let pandas handle it.
-            # If we want to match the previous specific list of fields, we can filter, 
-            # but usually keeping all data is better unless specified otherwise.
-            # For now, I will keep all columns to be safe and flexible.
-            
-            # Append to CSV
-            file_exists = os.path.isfile(CSV_FILE)
-            mode = 'a' if file_exists else 'w'
-            header = not file_exists
-            
-            df.to_csv(CSV_FILE, mode=mode, header=header, index=False)
+                    if short_left <= 0:
+                        wait = seconds_until_rate_limit_reset()
+                        print(f"Rate limit reached. Waiting {wait:.0f} seconds...")
+                        time.sleep(wait)
+                        budget = None
+                        waited = True
+                    else:
+                        window = min(window, short_left, daily_left)
+
+                pages = range(page, page + window)
+                responses = executor.map(lambda p: fetch_activity_page(session, p, after), pages)
+
+                # Responses are processed in page order
+                window_activities = []
+                for page, response in zip(pages, responses):
+                    budget = remaining_requests(response)
+
+                    if response.status_code == 429:
+                        if budget is None:
+                            print("Rate limit exceeded. Exiting.")
+                            done = True
+                        elif waited:
+                            # Still limited after the 15-minute reset: a daily
+                            # limit was hit, and waiting again will not help
+                            print("Rate limit still exceeded after waiting. Exiting.")
+                            done = True
+                        else:
+                            # Wait for the window to reset, then retry this page
+                            budget = (0, budget[1])
+                        break
+
+                    if response.status_code != 200:
+                        raise Exception(f"Failed to retrieve activities: {response.status_code} {response.text}")
+                    waited = False
+
+                    # Pages of 200 activities are large; orjson parses the raw bytes much faster than json
+                    activities = orjson.loads(response.content)
+                    page_activities = activities
+                    if last_activity_date:
+                        # Skip anything already saved in case 'after' includes the boundary
+                        # Note: String comparison works for ISO format dates, no parsing needed
+                        page_activities = [a for a in activities if a["start_date"] > last_activity_date]
+
+                    print(f"Page {page}: {len(page_activities)} new activities")
+
+                    if page_activities:
+                        # Pages run oldest first, so the last activity is the most recent so far
+                        latest_date = page_activities[-1]["start_date"]
+                        new_count += len(page_activities)
+                        window_activities.extend(page_activities)
+
+                    # A short page means we have caught up
+                    if len(activities) < PER_PAGE:
+                        done = True
+                        break
+                else:
+                    page += 1
+
+                if window_activities:
+                    new_frames.append(pd.json_normalize(window_activities))
+
+        if new_frames:
+            # Write all new activities in a single batch
+            append_activities_to_csv(pd.concat(new_frames, ignore_index=True))
             
             # Update metadata
-            # The new last_activity_date should be the date of the *most recent* activity found.
-            # Since we fetch newest first, it's the first item in new_activities.
-            latest_date = new_activities[0]["start_date"]
-            total_record_count += len(new_activities)
+            total_record_count += new_count
             
             save_metadata(total_record_count, latest_date)
-            print(f"Saved {len(new_activities)} new activities. Total records: {total_record_count}")
+            print(f"Saved {new_count} new activities. Total records: {total_record_count}")
         else:
             print("No new activities found.")
 
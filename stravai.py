@@ -2,10 +2,12 @@ import pandas as pd
 from langchain_experimental.agents import create_pandas_dataframe_agent
 from langchain_community.llms import OpenAI
 import os
-from dotenv import load_dotenv
+# Importing strava loads the shared .env file and defines where activities are stored
+from strava import CSV_FILE, migrate_legacy_csv
 
-dotenv_path='../secret/.env'
-load_dotenv(dotenv_path)
+# Activity columns the example queries need; loading only these keeps the
+# DataFrame handed to the agent small
+USED_COLUMNS = ['name', 'type', 'sport_type', 'start_date', 'distance', 'moving_time', 'gear_id', 'commute', 'average_heartrate']
 
 # Hugging Face API token (set up your token at https://huggingface.co/settings/tokens)
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
@@ -22,12 +24,33 @@ def setup_huggingface_llm():
     return llm
 
 # Load CSV data into a DataFrame
+# A Parquet copy is kept next to the CSV and reused until the CSV changes,
+# so repeated queries skip re-parsing the text file.
 def load_csv_data(file_path):
-    if os.path.exists(file_path):
-        return pd.read_csv(file_path)
-    else:
+    # A history saved before the CSV was compressed is moved over on first use
+    if file_path == CSV_FILE:
+        migrate_legacy_csv()
+    if not os.path.exists(file_path):
         raise FileNotFoundError(f"CSV file '{file_path}' not found.")
 
+    parquet_path = file_path.removesuffix(".gz").removesuffix(".csv") + ".parquet"
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(file_path):
+        df = pd.read_parquet(parquet_path)
+        # The copy only holds the columns that were used when it was written,
+        # so it is stale if USED_COLUMNS has changed since
+        header = pd.read_csv(file_path, nrows=0).columns
+        if set(df.columns) == {column for column in header if column in USED_COLUMNS}:
+            return df
+
+    # Columns the athlete never recorded (e.g. heart rate) are not in the CSV
+    df = pd.read_csv(file_path, usecols=lambda column: column in USED_COLUMNS, parse_dates=['start_date'])
+    try:
+        df.to_parquet(parquet_path, compression="zstd")
+    except (ImportError, TypeError, ValueError, OSError) as e:
+        # The cache is optional, the CSV remains the source of truth
+        print(f"Could not write Parquet cache: {e}")
+    return df
+
 # Query data using an AI model
 def query_data_with_openai(file_path, query):
     try:
@@ -76,7 +99,6 @@ if __name__ == "__main__":
     # get_activities_for_2024()
 
     ai_provider = 'hugging'
-    CSV_FILE = 'activities.csv'
 
     if ai_provider == 'hugging':
         # Example Queries
@@ -0,0 +1,86 @@
+import sys
+import pathlib
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+# Make the top-level strava modules importable once for the whole session
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import strava
+
+@pytest.fixture
+def metadata_store(monkeypatch):
+    """
+    Replaces the metadata file with an in-memory dict for tests that only need
+    fetch_new_activities to read and record progress.
+    """
+    store = {"record_count": 0, "last_activity_date": None}
+
+    def save(record_count, last_activity_date):
+        store.update(record_count=record_count, last_activity_date=last_activity_date)
+
+    monkeypatch.setattr(strava, "load_metadata", lambda: dict(store))
+    monkeypatch.setattr(strava, "save_metadata", save)
+    return store
+
+class FakeSession:
+    """
+    Stands in for requests.Session with only what strava uses: the headers
+    dict and a scriptable get(). Anything else raises AttributeError instead
+    of quietly returning a mock.
+    """
+    def __init__(self):
+        self.headers = {}
+        self.get = MagicMock()
+
+@pytest.fixture(scope="session")
+def shared_session():
+    """
+    One fake session for the whole run; tests only script its get().
+    """
+    return FakeSession()
+
+@pytest.fixture
+def fake_session(monkeypatch, shared_session):
+    """
+    Makes get_strava_session return the shared fake session with its headers
+    and get() reset.
+    """
+    shared_session.headers.clear()
+    shared_session.get.reset_mock(return_value=True, side_effect=True)
+    monkeypatch.setattr(strava, "get_strava_session", lambda: shared_session)
+    return shared_session
+
+@pytest.fixture
+def strava_env(monkeypatch, metadata_store, fake_session):
+    """
+    Wires fetch_new_activities to the fake session, the in-memory metadata
+    store and a CSV writer that only records the frames it is given. Every
+    save_metadata call is also recorded as a (record_count, last_activity_date)
+    tuple.
+    """
+    saved = []
+    store_save = strava.save_metadata
+
+    def save(record_count, last_activity_date):
+        saved.append((record_count, last_activity_date))
+        store_save(record_count, last_activity_date)
+
+    written = []
+    monkeypatch.setattr(strava, "save_metadata", save)
+    monkeypatch.setattr(strava, "_csv_writer", lambda df, path, **kwargs: written.append(df))
+    return SimpleNamespace(session=fake_session, metadata=metadata_store, saved=saved, written=written)
+
+@pytest.fixture(autouse=True)
+def isolated_files(tmp_path, monkeypatch):
+    """
+    Points every file strava reads or writes into the test's tmp_path, so no
+    test touches the data in a real checkout and tests can run in parallel
+    (pytest -n auto).
+    """
+    monkeypatch.setattr(strava, "METADATA_FILE", str(tmp_path / "activity_metadata.json"))
+    monkeypatch.setattr(strava, "CSV_FILE", str(tmp_path / "activities.csv.gz"))
+    monkeypatch.setattr(strava, "LEGACY_CSV_FILE", str(tmp_path / "activities.csv"))
+    monkeypatch.setattr(strava, "CACHE_FILE", str(tmp_path / ".strava_cache.json"))
+    return tmp_path
@@ -1,29 +1,51 @@
 import pytest
 import json
-import os
+import gzip
+import time
 import pandas as pd
-from unittest.mock import MagicMock, patch, mock_open
-import sys
+from collections import namedtuple
+from types import MappingProxyType, SimpleNamespace
+from unittest.mock import patch, mock_open
 
-# Add parent directory to path to import strava
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import strava
 
+def resp(status, payload=None, text="", headers=None):
+    """
+    Builds a lightweight stand-in for a requests.Response.
+    """
+    return SimpleNamespace(
+        status_code=status,
+        json=lambda: payload,
+        content=json.dumps(payload).encode(),
+        text=text,
+        headers=headers or {},
+    )
+
+# Payloads shared by the tests below, built once and read-only so no test can
+# change what another one sees
+_METADATA_JSON = '{"record_count": 10, "last_activity_date": "2024-01-01T00:00:00Z"}'
+
+# Full backfill: one short page of 2 activities, oldest first
+_BACKFILL_ACTIVITIES = tuple(MappingProxyType({"id": i, "start_date": f"2024-01-0{i}T00:00:00Z"}) for i in range(1, 3))
+
+# Oldest first: [Yesterday, Today]
+_STOP_ACTIVITIES = (
+    MappingProxyType({"id": 2, "start_date": "2024-01-02T00:00:00Z"}), # Old (match)
+    MappingProxyType({"id": 3, "start_date": "2024-01-03T00:00:00Z"}), # New
+)
+
 # --- Metadata Tests ---
 
-def test_load_metadata_file_exists():
-    mock_data = '{"record_count": 10, "last_activity_date": "2024-01-01T00:00:00Z"}'
-    with patch("builtins.open", mock_open(read_data=mock_data)):
-        with patch("os.path.exists", return_value=True):
-            metadata = strava.load_metadata()
-            assert metadata["record_count"] == 10
-            assert metadata["last_activity_date"] == "2024-01-01T00:00:00Z"
+def test_load_metadata(tmp_path):
+    metadata_path = tmp_path / "activity_metadata.json"
 
-def test_load_metadata_file_missing():
-    with patch("os.path.exists", return_value=False):
-        metadata = strava.load_metadata()
-        assert metadata["record_count"] == 0
-        assert metadata["last_activity_date"] is None
+    # Missing file falls back to an empty history
+    assert strava.load_metadata() == {"record_count": 0, "last_activity_date": None}
+
+    metadata_path.write_text(_METADATA_JSON)
+    metadata = strava.load_metadata()
+    assert metadata["record_count"] == 10
+    assert metadata["last_activity_date"] == "2024-01-01T00:00:00Z"
 
 def test_save_metadata():
     with patch("builtins.open", mock_open()) as mock_file:
@@ -39,191 +61,404 @@ def test_save_metadata():
 
 # --- Authentication Tests ---
 
-@patch("strava.requests.post")
-def test_get_strava_session_success(mock_post):
+@pytest.fixture
+def fake_session_factory(monkeypatch):
+    """
+    Builds sessions as bare header holders instead of real requests.Sessions.
+    """
+    monkeypatch.setattr(strava, "_session_factory", lambda: SimpleNamespace(headers={}))
+
+def test_create_session():
+    session = strava.create_session()
+
+    # Connections are pooled for the concurrent page fetches
+    adapter = session.get_adapter(strava.BASE_URL)
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == strava.PAGE_CONCURRENCY
+    assert adapter.max_retries.total == 3
+
+def test_get_strava_session_success(monkeypatch, fake_session_factory):
     # Mock successful token retrieval
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.json.return_value = {"access_token": "fake_token"}
-    mock_post.return_value = mock_response
+    calls = []
+    def fake_post(*args, **kwargs):
+        calls.append((args, kwargs))
+        return resp(200, {"access_token": "fake_token", "expires_at": time.time() + 3600})
+    monkeypatch.setattr(strava.requests, "post", fake_post)
 
     session = strava.get_strava_session()
     
     assert session.headers["Authorization"] == "Bearer fake_token"
-    mock_post.assert_called_once()
+    assert len(calls) == 1
+
+def test_get_strava_session_reuses_cached_token(monkeypatch, fake_session_factory):
+    strava.save_cache({"access_token": "cached_token", "expires_at": time.time() + 3600})
+
+    calls = []
+    monkeypatch.setattr(strava.requests, "post", lambda *args, **kwargs: calls.append((args, kwargs)))
+
+    session = strava.get_strava_session()
+
+    assert session.headers["Authorization"] == "Bearer cached_token"
+    assert calls == []
 
-@patch("strava.requests.post")
-def test_get_strava_session_failure(mock_post):
+def test_get_strava_session_ignores_cache_for_other_credentials(monkeypatch, fake_session_factory):
+    strava.save_cache({
+        "access_token": "old_account_token",
+        "expires_at": time.time() + 3600,
+        "athlete": {"id": 12345},
+        "athlete_fetched_at": time.time(),
+    })
+    # The user re-authorized, e.g. to add the activity:read_all scope
+    monkeypatch.setattr(strava, "STRAVA_REFRESH_TOKEN", "new_refresh_token")
+    monkeypatch.setattr(strava.requests, "post", lambda *args, **kwargs: resp(200, {"access_token": "new_token", "expires_at": time.time() + 21600}))
+
+    session = strava.get_strava_session()
+
+    assert session.headers["Authorization"] == "Bearer new_token"
+    # The athlete cached for the old credentials is gone too
+    assert "athlete" not in strava.load_cache()
+
+def test_get_strava_session_refreshes_expiring_token(tmp_path, monkeypatch, fake_session_factory):
+    cache_path = tmp_path / ".strava_cache.json"
+    strava.save_cache({"access_token": "old_token", "expires_at": time.time() + 30})
+
+    calls = []
+    def fake_post(*args, **kwargs):
+        calls.append((args, kwargs))
+        return resp(200, {"access_token": "new_token", "expires_at": time.time() + 21600})
+    monkeypatch.setattr(strava.requests, "post", fake_post)
+
+    session = strava.get_strava_session()
+
+    assert session.headers["Authorization"] == "Bearer new_token"
+    assert len(calls) == 1
+    assert json.loads(cache_path.read_text())["access_token"] == "new_token"
+
+def test_get_strava_session_failure(monkeypatch):
     # Mock failed token retrieval
-    mock_response = MagicMock()
-    mock_response.status_code = 400
-    mock_response.text = "Bad Request"
-    mock_post.return_value = mock_response
+    monkeypatch.setattr(strava.requests, "post", lambda *args, **kwargs: resp(400, text="Bad Request"))
 
-    with pytest.raises(Exception) as excinfo:
+    with pytest.raises(strava.StravaAuthError, match="Failed to get access token: 400 Bad Request"):
         strava.get_strava_session()
-    assert "Failed to get access token" in str(excinfo.value)
 
 # --- Stats Tests ---
 
-@patch("strava.get_strava_session")
-def test_get_athlete_stats(mock_get_session):
-    mock_session = MagicMock()
-    mock_get_session.return_value = mock_session
+def test_get_athlete_stats(fake_session):
     
     # Mock calls: 1. Athlete Profile, 2. Stats
-    mock_response_profile = MagicMock()
-    mock_response_profile.status_code = 200
-    mock_response_profile.json.return_value = {"id": 12345}
-    
-    mock_response_stats = MagicMock()
-    mock_response_stats.status_code = 200
-    mock_response_stats.json.return_value = {"biggest_ride_distance": 1000}
-    
-    mock_session.get.side_effect = [mock_response_profile, mock_response_stats]
+    fake_session.get.side_effect = [resp(200, {"id": 12345}), resp(200, {"biggest_ride_distance": 1000})]
 
     stats = strava.get_athlete_stats()
     assert stats["biggest_ride_distance"] == 1000
 
+def test_get_athlete_stats_reuses_cached_profile(fake_session):
+
+    fake_session.get.return_value = resp(200, {"biggest_ride_distance": 1000})
+
+    strava.save_cache({"athlete": {"id": 12345}, "athlete_fetched_at": time.time()})
+
+    stats = strava.get_athlete_stats()
+
+    assert stats["biggest_ride_distance"] == 1000
+    # Only the stats endpoint was requested
+    fake_session.get.assert_called_once_with(f"{strava.BASE_URL}/athletes/12345/stats")
+
 # --- Activity Fetching Tests ---
 
-@patch("strava.get_strava_session")
-@patch("strava.load_metadata")
-@patch("strava.save_metadata")
-@patch("strava.pd.DataFrame.to_csv") # Mock CSV writing
-def test_fetch_new_activities_pagination(mock_to_csv, mock_save, mock_load, mock_get_session):
-    # Setup metadata
-    mock_load.return_value = {"record_count": 0, "last_activity_date": None}
-    
-    mock_session = MagicMock()
-    mock_get_session.return_value = mock_session
+def pages(*payloads):
+    """
+    Yields one 200 response per page payload, built only when the session
+    asks for that page.
+    """
+    for payload in payloads:
+        # Read-only activities are copied back to dicts so they serialize
+        yield resp(200, [dict(activity) for activity in payload])
 
-    # Create fake activities
-    page1 = [{"id": i, "start_date": f"2024-01-0{i}T00:00:00Z"} for i in range(1, 3)] # 2 activities
-    page2 = [] # End of list
+Scenario = namedtuple("Scenario", "meta csv responses saves after text")
 
-    # Mock API responses
-    resp1 = MagicMock(); resp1.status_code = 200; resp1.json.return_value = page1
-    resp2 = MagicMock(); resp2.status_code = 200; resp2.json.return_value = page2
-    
-    mock_session.get.side_effect = [resp1, resp2]
+FETCH_SCENARIOS = {
+    # Full backfill: one short page of 2 activities, which ends the fetch after a
+    # single request (paging past full pages is covered by the concurrent pages
+    # test). With 'after' set the API returns oldest first, so the last item
+    # (2024-01-02) is the newest.
+    "backfill": Scenario(
+        meta=(0, None),
+        csv=False,
+        responses=lambda: pages(_BACKFILL_ACTIVITIES),
+        saves=[(2, "2024-01-02T00:00:00Z")],
+        after=0, # A full backfill still asks for ascending order
+        text="Saved 2 new activities",
+    ),
+    # Last activity was yesterday. API returns oldest first: [Yesterday, Today]
+    # Should skip Yesterday (boundary) and process Today: initial 10 + 1 new = 11
+    "stops_at_date": Scenario(
+        meta=(10, "2024-01-02T00:00:00Z"),
+        csv=True,
+        responses=lambda: pages(_STOP_ACTIVITIES),
+        saves=[(11, "2024-01-03T00:00:00Z")],
+        after=1704153600, # Only activities after 2024-01-02T00:00:00Z
+        text="Saved 1 new activities",
+    ),
+    # Metadata says 10 activities were saved, but the CSV is gone (e.g. a fresh
+    # clone): the progress is ignored and the full history is fetched again
+    "csv_missing": Scenario(
+        meta=(10, "2024-01-02T00:00:00Z"),
+        csv=False,
+        responses=lambda: pages(_STOP_ACTIVITIES),
+        saves=[(2, "2024-01-03T00:00:00Z")],
+        after=0,
+        text="Saved 2 new activities",
+    ),
+    # 429 without rate limit headers: print and exit the loop, NOT raise
+    "rate_limit": Scenario(
+        meta=(0, None),
+        csv=False,
+        responses=lambda: [resp(429)],
+        saves=[], # Nothing fetched, nothing saved
+        after=0,
+        text="Rate limit exceeded. Exiting.",
+    ),
+}
+
+@pytest.mark.parametrize("scenario", FETCH_SCENARIOS.values(), ids=FETCH_SCENARIOS.keys())
+def test_fetch_new_activities_scenarios(strava_env, tmp_path, capsys, scenario):
+    if scenario.csv:
+        (tmp_path / "activities.csv.gz").write_bytes(gzip.compress(b"id,start_date\n"))
+    strava_env.metadata.update(record_count=scenario.meta[0], last_activity_date=scenario.meta[1])
+    strava_env.session.get.side_effect = scenario.responses()
 
     strava.fetch_new_activities()
 
-    # Verify save_metadata was called with correct count (2) and date (newest is 2024-01-01)
-    # Note: In our loop, we append page1[0] first, which is id=1, date=...01
-    # Actually, the loop appends in order. The newest date depends on the API order.
-    # Assuming API returns newest first (standard), page1[0] is newest.
-    
-    assert mock_save.called
-    args, _ = mock_save.call_args
-    assert args[0] == 2 # record count
-    assert args[1] == "2024-01-01T00:00:00Z" # date of first item
-
-@patch("strava.get_strava_session")
-@patch("strava.load_metadata")
-@patch("strava.save_metadata")
-def test_fetch_new_activities_stops_at_date(mock_save, mock_load, mock_get_session):
-    # Setup metadata: Last activity was yesterday
-    mock_load.return_value = {"record_count": 10, "last_activity_date": "2024-01-02T00:00:00Z"}
-    
-    mock_session = MagicMock()
-    mock_get_session.return_value = mock_session
-
-    # API returns: [Today, Yesterday, DayBefore]
-    # Should process Today, see Yesterday and STOP.
-    activities = [
-        {"id": 3, "start_date": "2024-01-03T00:00:00Z"}, # New
-        {"id": 2, "start_date": "2024-01-02T00:00:00Z"}, # Old (match)
-        {"id": 1, "start_date": "2024-01-01T00:00:00Z"}, # Old (shouldn't be reached/processed)
-    ]
-
-    resp = MagicMock(); resp.status_code = 200; resp.json.return_value = activities
-    mock_session.get.return_value = resp
-
-    with patch("strava.pd.DataFrame.to_csv") as mock_to_csv:
-        strava.fetch_new_activities()
-        
-        # Should have saved 1 activity (id 3)
-        # Check the dataframe passed to to_csv
-        # It's hard to inspect the DF directly in mock call args without more complex logic,
-        # but we can check save_metadata count
-        
-        args, _ = mock_save.call_args
-        # Initial 10 + 1 new = 11
-        assert args[0] == 11 
-        assert args[1] == "2024-01-03T00:00:00Z"
-
-@patch("strava.get_strava_session")
-@patch("strava.load_metadata")
-def test_rate_limit_handling(mock_load, mock_get_session):
-    mock_load.return_value = {"record_count": 0, "last_activity_date": None}
-    mock_session = MagicMock()
-    mock_get_session.return_value = mock_session
-
-    # Return 429
-    resp = MagicMock(); resp.status_code = 429
-    mock_session.get.return_value = resp
-
-    # Should print message and exit loop, NOT raise exception
-    with patch("builtins.print") as mock_print:
-        strava.fetch_new_activities()
-        mock_print.assert_any_call("Rate limit exceeded. Exiting.")
-
-@patch("strava.get_strava_session")
-def test_get_athlete_stats_api_failure(mock_get_session):
-    mock_session = MagicMock()
-    mock_get_session.return_value = mock_session
-    
+    assert strava_env.saved == scenario.saves
+    # Exactly the new activities reached the CSV writer
+    # (without a CSV the run starts counting from zero)
+    start_count = scenario.meta[0] if scenario.csv else 0
+    new_count = scenario.saves[-1][0] - start_count if scenario.saves else 0
+    assert sum(len(df) for df in strava_env.written) == new_count
+    assert strava_env.session.get.call_count == 1
+    assert strava_env.session.get.call_args.kwargs["params"]["after"] == scenario.after
+    assert scenario.text in capsys.readouterr().out
+
+def test_get_athlete_stats_api_failure(fake_session, capsys):
     # Case 1: Athlete Profile fails
-    resp_fail = MagicMock(); resp_fail.status_code = 500; resp_fail.text = "Server Error"
-    mock_session.get.return_value = resp_fail
+    fake_session.get.return_value = resp(500, text="Server Error")
     
-    with patch("builtins.print") as mock_print:
-        stats = strava.get_athlete_stats()
-        assert stats is None
-        # Verify the exception message was printed
-        # The code catches Exception and prints it. 
-        # The exception raised is: Exception("Failed to retrieve athlete data: 500 Server Error")
-        # We check if print was called with an Exception object containing that text
-        args, _ = mock_print.call_args
-        assert "Failed to retrieve athlete data: 500 Server Error" in str(args[0])
+    stats = strava.get_athlete_stats()
+    assert stats is None
+    # Verify the exception message was printed
+    # The code catches Exception and prints it. 
+    # The exception raised is: Exception("Failed to retrieve athlete data: 500 Server Error")
+    assert "Failed to retrieve athlete data: 500 Server Error" in capsys.readouterr().out
 
     # Case 2: Athlete Profile succeeds, Stats fails
-    resp_ok = MagicMock(); resp_ok.status_code = 200; resp_ok.json.return_value = {"id": 123}
-    resp_fail_stats = MagicMock(); resp_fail_stats.status_code = 404; resp_fail_stats.text = "Not Found"
-    
-    mock_session.get.side_effect = [resp_ok, resp_fail_stats]
+    fake_session.get.side_effect = [resp(200, {"id": 123}), resp(404, text="Not Found")]
     
-    with patch("builtins.print") as mock_print:
-        stats = strava.get_athlete_stats()
-        assert stats is None
-        args, _ = mock_print.call_args
-        assert "Failed to retrieve stats: 404 Not Found" in str(args[0])
-
-@patch("strava.get_strava_session")
-@patch("strava.load_metadata")
-def test_fetch_new_activities_api_failure(mock_load, mock_get_session):
-    mock_load.return_value = {"record_count": 0, "last_activity_date": None}
-    mock_session = MagicMock()
-    mock_get_session.return_value = mock_session
+    stats = strava.get_athlete_stats()
+    assert stats is None
+    assert "Failed to retrieve stats: 404 Not Found" in capsys.readouterr().out
 
+def test_fetch_new_activities_api_failure(strava_env, capsys):
     # Return generic error (e.g. 500)
-    resp = MagicMock(); resp.status_code = 500; resp.text = "Internal Error"
-    mock_session.get.return_value = resp
+    strava_env.session.get.return_value = resp(500, text="Internal Error")
 
-    with patch("builtins.print") as mock_print:
-        strava.fetch_new_activities()
-        # Should catch the exception and print it
-        # The exception raised is: Exception("Failed to retrieve activities: 500 Internal Error")
-        
-        # We need to find the call that prints the error.
-        # It prints "An error occurred: ..."
-        
-        found = False
-        for call in mock_print.mock_calls:
-            arg = str(call.args[0])
-            if "An error occurred:" in arg and "Failed to retrieve activities: 500 Internal Error" in arg:
-                found = True
-                break
-        assert found
+    strava.fetch_new_activities()
+    # Should catch the exception and print it
+    # The exception raised is: Exception("Failed to retrieve activities: 500 Internal Error")
+    assert "An error occurred: Failed to retrieve activities: 500 Internal Error" in capsys.readouterr().out
+
+def test_fetch_new_activities_migrates_legacy_csv_without_new_activities(strava_env, tmp_path, capsys):
+    legacy_path = tmp_path / "activities.csv"
+    legacy_path.write_text("id,name\n1,Morning Run\n")
+    strava_env.metadata.update(record_count=1, last_activity_date="2024-01-01T00:00:00Z")
+    strava_env.session.get.return_value = resp(200, [])
+
+    strava.fetch_new_activities()
+
+    assert "No new activities found." in capsys.readouterr().out
+    lines = gzip.decompress((tmp_path / "activities.csv.gz").read_bytes()).decode().splitlines()
+    assert lines == ["id,name", "1,Morning Run"]
+
+def test_fetch_new_activities_reports_migration_errors(strava_env, tmp_path, monkeypatch, capsys):
+    (tmp_path / "activities.csv").write_text("id,name\n1,Morning Run\n")
+    # The compressed CSV cannot be created in a missing directory
+    monkeypatch.setattr(strava, "CSV_FILE", str(tmp_path / "missing" / "activities.csv.gz"))
+
+    strava.fetch_new_activities()
+
+    assert "An error occurred:" in capsys.readouterr().out
+    strava_env.session.get.assert_not_called()
+
+def test_fetch_new_activities_concurrent_pages(strava_env):
+    # Two full pages followed by a partial one, oldest first
+    dates = [f"2024-01-01T{i // 60:02d}:{i % 60:02d}:00Z" for i in range(2 * strava.PER_PAGE + 10)]
+    page_dates = {
+        1: dates[:strava.PER_PAGE],
+        2: dates[strava.PER_PAGE:2 * strava.PER_PAGE],
+        3: dates[2 * strava.PER_PAGE:],
+    }
+
+    def fake_get(url, params):
+        return resp(200, [{"start_date": d} for d in page_dates.get(params["page"], [])])
+
+    strava_env.session.get.side_effect = fake_get
+
+    strava.fetch_new_activities()
+
+    requested = sorted(call.kwargs["params"]["page"] for call in strava_env.session.get.mock_calls)
+    assert requested == [1, 2, 3, 4, 5]
+    assert strava_env.saved == [(len(dates), dates[-1])]
+
+# --- CSV Writing Tests ---
+
+def test_append_activities_to_csv_writes_header_once(tmp_path):
+    csv_path = tmp_path / "activities.csv.gz"
+    strava.append_activities_to_csv(pd.json_normalize([{"id": 1, "map": {"id": "a1"}}]))
+    strava.append_activities_to_csv(pd.json_normalize([{"id": 2, "map": {"id": "a2"}}]))
+
+    lines = gzip.decompress(csv_path.read_bytes()).decode().splitlines()
+    assert lines == ["id,map.id", "1,a1", "2,a2"]
+
+def test_append_activities_to_csv_follows_existing_header(tmp_path):
+    csv_path = tmp_path / "activities.csv.gz"
+    csv_path.write_bytes(gzip.compress(b"id,name,map.id\n1,Morning Run,a1\n"))
+    # Keys arrive in a different order and one field is missing
+    strava.append_activities_to_csv(pd.json_normalize([{"map": {"id": "a2"}, "id": 2}]))
+
+    lines = gzip.decompress(csv_path.read_bytes()).decode().splitlines()
+    assert lines[-1] == "2,,a2"
+
+def test_append_activities_to_csv_empty_file_gets_header(tmp_path):
+    csv_path = tmp_path / "activities.csv.gz"
+    csv_path.touch()
+    strava.append_activities_to_csv(pd.json_normalize([{"id": 1}]))
+
+    assert gzip.decompress(csv_path.read_bytes()).decode().splitlines() == ["id", "1"]
+
+def test_append_activities_to_csv_migrates_legacy_csv(tmp_path):
+    csv_path = tmp_path / "activities.csv.gz"
+    legacy_path = tmp_path / "activities.csv"
+    legacy_path.write_text("id,name\n1,Morning Run\n")
+    strava.append_activities_to_csv(pd.json_normalize([{"id": 2, "name": "Evening Ride"}]))
+
+    lines = gzip.decompress(csv_path.read_bytes()).decode().splitlines()
+    assert lines == ["id,name", "1,Morning Run", "2,Evening Ride"]
+
+def test_migrate_legacy_csv_interrupted_copy_can_be_retried(tmp_path):
+    legacy_path = tmp_path / "activities.csv"
+    legacy_path.write_text("id,name\n1,Morning Run\n")
+
+    def interrupted(src, dst):
+        dst.write(b"id,na")
+        raise KeyboardInterrupt
+
+    with patch("strava.shutil.copyfileobj", interrupted), pytest.raises(KeyboardInterrupt):
+        strava.migrate_legacy_csv()
+    # Neither a truncated CSV nor the temp file is left behind
+    assert [path.name for path in tmp_path.iterdir()] == ["activities.csv"]
+
+    strava.migrate_legacy_csv()
+    assert gzip.decompress((tmp_path / "activities.csv.gz").read_bytes()) == b"id,name\n1,Morning Run\n"
+
+def test_append_activities_to_csv_skips_empty_columns(tmp_path):
+    csv_path = tmp_path / "activities.csv.gz"
+    strava.append_activities_to_csv(pd.json_normalize([
+        {"id": 1, "average_heartrate": None},
+        {"id": 2, "average_heartrate": None},
+    ]))
+
+    lines = gzip.decompress(csv_path.read_bytes()).decode().splitlines()
+    assert lines == ["id", "1", "2"]
+
+def test_append_activities_to_csv_widens_header_for_new_fields(tmp_path):
+    csv_path = tmp_path / "activities.csv.gz"
+    csv_path.write_bytes(gzip.compress(b"id,name,distance\n1,Morning Run,5000.0\n"))
+    strava.append_activities_to_csv(pd.json_normalize([{"id": 2, "average_heartrate": 140.2}]))
+
+    lines = gzip.decompress(csv_path.read_bytes()).decode().splitlines()
+    assert lines == ["id,name,distance,average_heartrate", "1,Morning Run,5000.0,", "2,,,140.2"]
+    assert [path.name for path in tmp_path.iterdir()] == ["activities.csv.gz"]
+
+def test_append_activities_to_csv_failed_rewrite_keeps_history(tmp_path, monkeypatch):
+    csv_path = tmp_path / "activities.csv.gz"
+    csv_path.write_bytes(gzip.compress(b"id,name\n1,Morning Run\n"))
+
+    def failing_writer(df, path, **kwargs):
+        with open(path, "wb") as f:
+            f.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(strava, "_csv_writer", failing_writer)
+    with pytest.raises(OSError):
+        strava.append_activities_to_csv(pd.json_normalize([{"id": 2, "average_heartrate": 140.2}]))
+
+    assert gzip.decompress(csv_path.read_bytes()) == b"id,name\n1,Morning Run\n"
+    assert [path.name for path in tmp_path.iterdir()] == ["activities.csv.gz"]
+
+# --- Rate Limit Tests ---
+
+def test_remaining_requests():
+    limited = resp(200, headers={"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "98,400"})
+    assert strava.remaining_requests(limited) == (2, 600)
+
+    # The activity list also counts against the lower read limit
+    read_limited = resp(200, headers={
+        "X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "10,400",
+        "X-ReadRateLimit-Limit": "100,1000", "X-ReadRateLimit-Usage": "10,995",
+    })
+    assert strava.remaining_requests(read_limited) == (90, 5)
+
+    assert strava.remaining_requests(resp(200)) is None
+
+def test_seconds_until_rate_limit_reset_waits_past_boundary(monkeypatch):
+    # 10 seconds before a quarter hour
+    boundary = 1000 * strava.RATE_LIMIT_WINDOW
+    monkeypatch.setattr(strava.time, "time", lambda: boundary - 10)
+
+    wait = strava.seconds_until_rate_limit_reset()
+
+    assert wait == 10 + strava.RATE_LIMIT_RESET_MARGIN
+    assert boundary < boundary - 10 + wait < boundary + strava.RATE_LIMIT_WINDOW
+
+@patch("strava.time.sleep")
+def test_rate_limit_waits_and_retries(mock_sleep, strava_env):
+    # 15-minute budget used up, but daily budget left
+    resp_limited = resp(429, headers={"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,400"})
+    resp_ok = resp(
+        200,
+        [{"id": 1, "start_date": "2024-01-01T00:00:00Z"}],
+        headers={"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "1,401"},
+    )
+
+    strava_env.session.get.side_effect = [resp_limited, resp_ok]
+
+    strava.fetch_new_activities()
+
+    mock_sleep.assert_called_once()
+    assert strava_env.saved == [(1, "2024-01-01T00:00:00Z")]
+
+@patch("strava.time.sleep")
+def test_rate_limit_stops_when_still_limited_after_waiting(mock_sleep, strava_env, capsys):
+    # The daily read limit is spent while the overall headers still show room
+    strava_env.session.get.return_value = resp(429, headers={"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "200,400"})
+
+    strava.fetch_new_activities()
+
+    assert "Rate limit still exceeded after waiting. Exiting." in capsys.readouterr().out
+    mock_sleep.assert_called_once()
+    assert strava_env.session.get.call_count == 2
+    assert strava_env.saved == []
+
+def test_daily_rate_limit_stops_fetching(strava_env, capsys):
+    # A full page that used up the daily budget
+    strava_env.session.get.return_value = resp(
+        200,
+        [{"id": i, "start_date": f"2024-01-01T{i // 60:02d}:{i % 60:02d}:00Z"} for i in range(strava.PER_PAGE)],
+        headers={"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "50,1000"},
+    )
+
+    strava.fetch_new_activities()
+    assert "Daily rate limit reached. Exiting." in capsys.readouterr().out
+
+    assert strava_env.session.get.call_count == 1
+    # Pages run oldest first, so the partial progress is safe to save
+    last = strava.PER_PAGE - 1
+    assert strava_env.saved == [(strava.PER_PAGE, f"2024-01-01T{last // 60:02d}:{last % 60:02d}:00Z")]
@@ -0,0 +1,67 @@
+import os
+import gzip
+import pytest
+import pandas as pd
+
+import stravai
+
+_CSV = b"id,name,start_date,distance,map.id\n1,Morning Run,2024-01-01T07:00:00Z,5000.0,a1\n"
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "activities.csv.gz"
+    path.write_bytes(gzip.compress(_CSV))
+    return path
+
+def test_load_csv_data_reads_used_columns_and_writes_parquet(csv_path):
+    df = stravai.load_csv_data(str(csv_path))
+
+    # Only the columns the queries need are kept
+    assert list(df.columns) == ["name", "start_date", "distance"]
+    assert pd.api.types.is_datetime64_any_dtype(df["start_date"])
+    assert (csv_path.parent / "activities.parquet").exists()
+
+def test_load_csv_data_reuses_fresh_parquet(csv_path, monkeypatch):
+    stravai.load_csv_data(str(csv_path))
+
+    read_csv = pd.read_csv
+
+    def header_only(*args, **kwargs):
+        # Checking the header is fine, parsing the rows again is not
+        assert kwargs.get("nrows") == 0, "CSV should not be parsed again"
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(stravai.pd, "read_csv", header_only)
+    assert stravai.load_csv_data(str(csv_path))["name"].tolist() == ["Morning Run"]
+
+def test_load_csv_data_ignores_stale_parquet(csv_path):
+    stravai.load_csv_data(str(csv_path))
+
+    # New activities were appended after the Parquet copy was written
+    csv_path.write_bytes(gzip.compress(_CSV + b"2,Evening Ride,2024-01-02T18:00:00Z,20000.0,a2\n"))
+    parquet_mtime = os.path.getmtime(csv_path.parent / "activities.parquet")
+    os.utime(csv_path, (parquet_mtime + 1, parquet_mtime + 1))
+
+    assert stravai.load_csv_data(str(csv_path))["name"].tolist() == ["Morning Run", "Evening Ride"]
+
+def test_load_csv_data_ignores_parquet_with_other_columns(csv_path, monkeypatch):
+    stravai.load_csv_data(str(csv_path))
+
+    # A query now needs a column the Parquet copy was written without
+    monkeypatch.setattr(stravai, "USED_COLUMNS", stravai.USED_COLUMNS + ["map.id"])
+
+    assert "map.id" in stravai.load_csv_data(str(csv_path)).columns
+    assert "map.id" in pd.read_parquet(csv_path.parent / "activities.parquet").columns
+
+def test_load_csv_data_survives_unwritable_parquet(csv_path, monkeypatch, capsys):
+    def read_only(*args, **kwargs):
+        raise PermissionError("Permission denied")
+
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", read_only)
+
+    assert stravai.load_csv_data(str(csv_path))["name"].tolist() == ["Morning Run"]
+    assert "Could not write Parquet cache: Permission denied" in capsys.readouterr().out
+
+def test_load_csv_data_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        stravai.load_csv_data(str(tmp_path / "missing.csv.gz"))